@@ -14,15 +14,351 @@ Note on message format (verified via debug filter 2024-12):
     - No tool_calls array in assistant messages
 """
 
+import asyncio
 import html
+import importlib.util
 import json
+import logging
+import os
 import re
 import traceback
 import tiktoken
 import httpx
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import lru_cache
 from typing import Optional, Callable, Any, Awaitable, Tuple
 from pydantic import BaseModel, Field
 
+# Debug output is only emitted when the debug_logging / dump_full_messages
+# valves are on, so it goes out at INFO to show under Open WebUI's default level
+_logger = logging.getLogger("context_summarization")
+
+# HTTP/2 needs the optional h2 package; fall back to HTTP/1.1 without it
+_HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+# tiktoken releases the GIL while encoding, so batches spread across cores.
+# encode_ordinary_batch starts a fresh thread pool per call, so stay within the
+# CPUs this process may use (cpu_count ignores container limits) and cap at
+# tiktoken's own default of 8
+_ENCODE_THREADS = min(
+    8,
+    (
+        len(os.sched_getaffinity(0))
+        if hasattr(os, "sched_getaffinity")
+        else os.cpu_count() or 1
+    ),
+)
+
+# orjson parses tool-result JSON several times faster; stdlib json otherwise
+try:
+    import orjson as _orjson
+except ImportError:
+    _orjson = None
+
+# Patterns indicating embedded tool results, combined into one alternation:
+# 1. HTML-escaped JSON: &quot;results&quot; or &quot;error&quot;
+# 2. Double-escaped JSON: \"results\" or \\&quot;
+# 3. Raw JSON patterns at start: {"results" or [{"
+_TOOL_RESULT_RE = re.compile(
+    "|".join(
+        [
+            r"&quot;results&quot;",
+            r"&quot;error&quot;",
+            r"\\&quot;results\\&quot;",
+            r'\\"results\\"',
+            r'^[\s\n]*\{["\']results',
+            r"^[\s\n]*\[\{",
+            r'^[\s\n]*"&quot;',  # Starts with escaped quote (common pattern)
+        ]
+    )
+)
+_ERROR_PHRASE = "query execution failed"
+_ERROR_RE = re.compile(_ERROR_PHRASE, re.IGNORECASE)
+_RESULTS_JSON_RE = re.compile(r'\{\s*"results"\s*:\s*\[([\s\S]*?)\]\s*\}')
+_JSON_ARRAY_RE = re.compile(r"\[\s*\{[\s\S]*?\}\s*\]")
+_TOOL_SUMMARY_RE = re.compile(r"(\[Tool:[^\]]+\])")
+# End of a JSON block: }" or }' or }]"
+_JSON_BLOCK_END_RE = re.compile(r"\}(?:\]?\"|')")
+_LEADING_QUOTES_RE = re.compile(r'^[\s"\'\n]+')
+_RESULTS_ARRAY_OPEN_RE = re.compile(r"\s*:\s*\[")
+_OBJECT_ARRAY_OPEN_RE = re.compile(r"\[\s*\{")
+# Escape sequences (consumed whole), string delimiters and square brackets:
+# everything that matters when matching a JSON array's closing bracket
+_JSON_SCAN_RE = re.compile(r'\\.|["\[\]]', re.DOTALL)
+_BACKSLASH_ESCAPE_RE = re.compile(r'\\([n"])')
+_BACKSLASH_ESCAPES = {"n": "\n", '"': '"'}
+# Entities Open WebUI emits for tool results; &amp; is decoded last so it
+# can't create new entities
+_ENTITY_MAP = {"&quot;": '"', "&#x27;": "'", "&#39;": "'", "&lt;": "<", "&gt;": ">"}
+
+# Summarization prompt pieces; roles are uppercased once here, not per message
+_ROLE_UPPER = {
+    "user": "USER",
+    "assistant": "ASSISTANT",
+    "system": "SYSTEM",
+    "unknown": "UNKNOWN",
+}
+_SUMMARY_PROMPT_HEADER = (
+    "Summarize the following conversation concisely, preserving key facts, "
+    "decisions, queries made, and context needed to continue the conversation:"
+    "\n\n"
+)
+_SUMMARY_PROMPT_FOOTER = "\n\nProvide a clear, factual summary in 2-3 paragraphs."
+
+_JSON_HEADERS = {"content-type": "application/json"}
+
+# Pooled client for Ollama calls, created on first use and shared by every
+# Filter instance so connections are kept alive across requests
+_CLIENT: Optional[httpx.AsyncClient] = None
+
+# Per-message token counts for the inlet call in progress, keyed by id(msg).
+# Open WebUI shares one Filter across concurrent chats, so the cache lives in
+# a ContextVar: each inlet sees only its own dict (as do the worker threads it
+# starts with asyncio.to_thread, which copy the context), and the dict is
+# dropped when the call returns. Outside inlet nothing is cached.
+_MSG_TOKENS: ContextVar[Optional[dict]] = ContextVar("_MSG_TOKENS", default=None)
+# Token counts keyed by the text itself, so identical strings (repeated
+# prompts, shared context) are encoded once per inlet; scoped the same way
+_TEXT_TOKENS: ContextVar[Optional[dict]] = ContextVar("_TEXT_TOKENS", default=None)
+
+
+@contextmanager
+def _call_caches():
+    """Give the enclosed call its own token caches, discarded on exit."""
+    reset_msg = _MSG_TOKENS.set({})
+    reset_text = _TEXT_TOKENS.set({})
+    try:
+        yield
+    finally:
+        _TEXT_TOKENS.reset(reset_text)
+        _MSG_TOKENS.reset(reset_msg)
+
+
+def _get_client() -> httpx.AsyncClient:
+    """Return the shared Ollama client, creating it on first use."""
+    global _CLIENT
+    if _CLIENT is None:
+        _CLIENT = httpx.AsyncClient(
+            timeout=120.0,
+            http2=_HTTP2_AVAILABLE,
+            limits=httpx.Limits(max_connections=50, max_keepalive_connections=10),
+        )
+    return _CLIENT
+
+
+@lru_cache(maxsize=4)
+def _get_encoding(name: str = "cl100k_base") -> tiktoken.Encoding:
+    """Load a tiktoken encoding once per process, shared by all Filter instances."""
+    return tiktoken.get_encoding(name)
+
+
+def _unescape_entities(text: str) -> str:
+    """
+    Decode HTML entities, exactly as html.unescape would.
+
+    Tool results only use a handful of entities, and chained str.replace calls
+    run in C, several times faster than html.unescape's per-entity callback.
+    Anything else left over falls back to html.unescape.
+    """
+    decoded = text
+    for entity, char in _ENTITY_MAP.items():
+        if entity in decoded:
+            decoded = decoded.replace(entity, char)
+    if decoded.count("&") != decoded.count("&amp;"):
+        return html.unescape(text)
+    return decoded.replace("&amp;", "&")
+
+
+def _unescape_backslashes(text: str) -> str:
+    """Undo \\" and \\n escapes left by JSON serialization in a single pass."""
+    return _BACKSLASH_ESCAPE_RE.sub(lambda m: _BACKSLASH_ESCAPES[m.group(1)], text)
+
+
+def _find_array_end(text: str, start: int) -> int:
+    """
+    Return the index of the "]" closing the JSON array that opens at text[start].
+
+    Brackets inside strings are ignored. Returns -1 if the array is unterminated.
+    """
+    depth = 0
+    in_string = False
+    for match in _JSON_SCAN_RE.finditer(text, start):
+        token = match.group()
+        if token == '"':
+            in_string = not in_string
+        elif in_string or len(token) == 2:
+            continue
+        elif token == "[":
+            depth += 1
+        else:
+            depth -= 1
+            if depth == 0:
+                return match.start()
+    return -1
+
+
+def _rfind_json_block_end(text: str, window: int = 4096) -> int:
+    """
+    Return the index of the last JSON block end in text, or -1.
+
+    Commentary normally follows the tool output closely, so only the last
+    window characters are scanned unless no block end appears there.
+    """
+    tail_start = max(len(text) - window, 0)
+    last = -1
+    for match in _JSON_BLOCK_END_RE.finditer(text, tail_start):
+        last = match.start()
+    if last < 0 and tail_start:
+        for match in _JSON_BLOCK_END_RE.finditer(text):
+            last = match.start()
+    return last
+
+
+def _format_sample_row(row: dict, limit: int = 120) -> str:
+    """
+    Format a row as json.dumps would, truncated to limit characters.
+
+    Serialization stops once the limit is passed, so wide rows cost bounded work.
+    """
+    pieces = ["{"]
+    length = 1
+    for i, (key, value) in enumerate(row.items()):
+        separator = ", " if i else ""
+        key_json = json.dumps(str(key), ensure_ascii=False)
+        piece = f"{separator}{key_json}: {json.dumps(value, ensure_ascii=False)}"
+        pieces.append(piece)
+        length += len(piece)
+        if length > limit:
+            break
+    else:
+        pieces.append("}")
+
+    text = "".join(pieces)
+    if len(text) > limit:
+        return text[:limit] + "...}"
+    return text
+
+
+def _utf8_len(text: str) -> int:
+    """UTF-8 byte length; byte-level BPE never yields more tokens than this."""
+    if text.isascii():
+        return len(text)
+    return len(text.encode("utf-8", "surrogatepass"))
+
+
+def _count_errors(text: str) -> int:
+    """Count case-insensitive "query execution failed" occurrences."""
+    if text.isascii():
+        # Lowercasing plus str.count beats the case-insensitive regex ~10x;
+        # non-ASCII text keeps the regex, whose case folding differs from
+        # str.lower for a few characters
+        return text.lower().count(_ERROR_PHRASE)
+    return sum(1 for _ in _ERROR_RE.finditer(text))
+
+
+def _json_loads(text: str) -> Any:
+    """Parse JSON with orjson when available, falling back to the stdlib parser."""
+    if _orjson is not None:
+        try:
+            return _orjson.loads(text)
+        except _orjson.JSONDecodeError:
+            # orjson rejects NaN/Infinity and lone surrogates that json
+            # accepts; let json decide
+            pass
+    return json.loads(text)
+
+
+def _json_dumps_bytes(payload: Any) -> bytes:
+    """Serialize a request body to UTF-8 JSON, with orjson when available."""
+    if _orjson is not None:
+        try:
+            return _orjson.dumps(payload)
+        except TypeError:
+            # orjson refuses lone surrogates; json escapes them as \uXXXX
+            pass
+    return json.dumps(payload).encode()
+
+
+def _preview(messages: list, limit: int = 500) -> str:
+    """
+    First limit characters of the non-blank string contents, without
+    building the full text they'd be joined into.
+    """
+    parts = []
+    remaining = limit
+    for msg in messages:
+        content = msg.get("content", "")
+        if not isinstance(content, str) or not content or content.isspace():
+            continue
+        parts.append(content[:remaining])
+        remaining -= len(parts[-1])
+        if remaining <= 0:
+            break
+    return "\n\n".join(parts)
+
+
+def _parse_json_array(text: str, start: int) -> Optional[list]:
+    """Parse the JSON array that opens at text[start], or None if it won't parse."""
+    end = _find_array_end(text, start)
+    if end < 0:
+        return None
+    try:
+        data = _json_loads(_unescape_backslashes(text[start : end + 1]))
+    except json.JSONDecodeError:
+        return None
+    return data if isinstance(data, list) else None
+
+
+def _find_results_array(text: str) -> Optional[list]:
+    """Find and parse the array under a "results" key by bracket matching."""
+    idx = text.find('"results"')
+    while idx >= 0:
+        opener = _RESULTS_ARRAY_OPEN_RE.match(text, idx + len('"results"'))
+        if opener:
+            results = _parse_json_array(text, opener.end() - 1)
+            if results is not None:
+                return results
+        idx = text.find('"results"', idx + 1)
+    return None
+
+
+def _find_object_array(text: str) -> Optional[list]:
+    """Find and parse the first array of objects by bracket matching."""
+    opener = _OBJECT_ARRAY_OPEN_RE.search(text)
+    if not opener:
+        return None
+    return _parse_json_array(text, opener.start()) or None
+
+
+def _match_results_array(text: str) -> Optional[list]:
+    """Regex fallback for a {"results": [...]} object."""
+    results_match = _RESULTS_JSON_RE.search(text)
+    if not results_match:
+        return None
+    try:
+        json_str = '{"results": [' + results_match.group(1) + "]}"
+        data = _json_loads(_unescape_backslashes(json_str))
+    except json.JSONDecodeError:
+        return None
+    if "results" in data and isinstance(data["results"], list):
+        return data["results"]
+    return None
+
+
+def _match_object_array(text: str) -> Optional[list]:
+    """Regex fallback for a raw JSON array of objects."""
+    array_match = _JSON_ARRAY_RE.search(text)
+    if not array_match:
+        return None
+    try:
+        data = _json_loads(_unescape_backslashes(array_match.group(0)))
+    except json.JSONDecodeError:
+        return None
+    if isinstance(data, list) and data:
+        return data
+    return None
+
 
 class Filter:
     class Valves(BaseModel):
@@ -46,10 +382,18 @@ class Filter:
             default="",
             description="Model for summarization (empty = use chat model)",
         )
+        summary_chunk_tokens: int = Field(
+            default=0,
+            description="Split summarization into concurrent requests of about this many tokens (0 = single request)",
+        )
         tool_result_token_threshold: int = Field(
             default=500,
             description="Compact tool results in assistant messages exceeding this token count",
         )
+        enable_fast_token_estimate: bool = Field(
+            default=True,
+            description="Skip exact token counting when the UTF-8 byte length (an upper bound on tokens) is under token_threshold",
+        )
         debug_logging: bool = Field(
             default=False,
             description="Enable detailed debug logging (visible in container logs)",
@@ -60,14 +404,18 @@ class Filter:
         )
         priority: int = Field(default=0)
 
+    # Image parts can't be tokenized as text; charge each a flat, low-detail
+    # vision cost so image-heavy conversations still approach the threshold
+    IMAGE_PART_TOKENS = 85
+
     def __init__(self):
         self.valves = self.Valves()
-        self.encoding = tiktoken.get_encoding("cl100k_base")
+        self.encoding = _get_encoding()
 
     def _debug(self, message: str) -> None:
-        """Print debug message if debug logging is enabled."""
+        """Log debug message if debug logging is enabled."""
         if self.valves.debug_logging:
-            print(f"[ContextSummarization] {message}")
+            _logger.info("[ContextSummarization] %s", message)
 
     def _format_messages_summary(self, messages: list, label: str = "Messages") -> str:
         """Format a summary of messages for debug logging."""
@@ -75,53 +423,215 @@ class Filter:
             return f"{label}: (empty)"
 
         lines = [f"{label}: {len(messages)} messages"]
+        count_message_tokens = self.count_message_tokens
         for i, msg in enumerate(messages):
-            role = msg.get("role", "unknown")
-            content = msg.get("content", "")
-            tokens = self.count_message_tokens(msg)
+            get = msg.get
+            role = get("role", "unknown")
+            content = get("content", "")
+            tokens = count_message_tokens(msg)
 
             if isinstance(content, str):
-                if self.valves.dump_full_messages:
-                    # Full content - no truncation
-                    lines.append(f"  [{i}] {role}: {tokens} tokens")
-                    lines.append(f"--- START CONTENT ---")
-                    lines.append(content)
-                    lines.append(f"--- END CONTENT ---")
-                else:
-                    # Truncated preview
-                    preview = content[:80].replace("\n", " ")
-                    if len(content) > 80:
-                        preview += "..."
-                    lines.append(f"  [{i}] {role}: {tokens} tokens - {preview}")
+                # Truncated preview
+                preview = content[:80].replace("\n", " ")
+                if len(content) > 80:
+                    preview += "..."
+                lines.append(f"  [{i}] {role}: {tokens} tokens - {preview}")
             else:
                 lines.append(
                     f"  [{i}] {role}: {tokens} tokens - [{type(content).__name__}]"
                 )
         return "\n".join(lines)
 
+    def _debug_messages(self, messages: list, label: str) -> None:
+        """
+        Log a summary of messages, or their full content if dump_full_messages.
+
+        Full dumps are logged one record per message rather than joined into
+        a single string alongside the messages themselves.
+        """
+        if not self.valves.debug_logging:
+            return
+        if not messages or not self.valves.dump_full_messages:
+            self._debug(self._format_messages_summary(messages, label))
+            return
+
+        info = _logger.info
+        info("[ContextSummarization] %s: %d messages", label, len(messages))
+        count_message_tokens = self.count_message_tokens
+        for i, msg in enumerate(messages):
+            get = msg.get
+            role = get("role", "unknown")
+            content = get("content", "")
+            tokens = count_message_tokens(msg)
+
+            if isinstance(content, str):
+                # Full content - no truncation
+                info(
+                    "  [%d] %s: %d tokens\n--- START CONTENT ---\n%s\n--- END CONTENT ---",
+                    i,
+                    role,
+                    tokens,
+                    content,
+                )
+            else:
+                info(
+                    "  [%d] %s: %d tokens - [%s]",
+                    i,
+                    role,
+                    tokens,
+                    type(content).__name__,
+                )
+
     def count_tokens(self, text: str) -> int:
         """Count tokens in a string using tiktoken."""
         if not text:
             return 0
-        return len(self.encoding.encode(text))
-
-    def count_message_tokens(self, msg: dict) -> int:
-        """Count tokens in a message."""
+        cache = _TEXT_TOKENS.get()
+        count = cache.get(text) if cache is not None else None
+        if count is None:
+            # Chat content is opaque text, so skip the special-token scan
+            count = len(self.encoding.encode_ordinary(text))
+            if cache is not None:
+                cache[text] = count
+        return count
+
+    @staticmethod
+    def _cache_lookup(
+        msg: dict, cache: Optional[dict]
+    ) -> Tuple[Any, Optional[tuple], Optional[int]]:
+        """Return (content, parts_key, cached_count or None) for a message."""
         content = msg.get("content", "")
+        if cache is None:
+            return content, None, None
+        # Multimodal parts can be swapped in place, so key on them as well
+        parts = (
+            tuple(id(item) for item in content) if isinstance(content, list) else None
+        )
+        # Entries keep a reference to the content they were computed from so a
+        # recycled id can never return a stale count
+        cached = cache.get(id(msg))
+        if cached is not None and cached[0] is content and cached[1] == parts:
+            return content, parts, cached[2]
+        return content, parts, None
+
+    @staticmethod
+    def _text_segments(content: Any) -> list:
+        """Return the non-empty text strings in message content."""
         if isinstance(content, str):
-            return self.count_tokens(content)
-        elif isinstance(content, list):
+            return [content] if content else []
+        if isinstance(content, list):
             # Multimodal content
-            total = 0
-            for item in content:
-                if isinstance(item, dict) and item.get("type") == "text":
-                    total += self.count_tokens(item.get("text", ""))
-            return total
-        return 0
+            return [
+                item["text"]
+                for item in content
+                if isinstance(item, dict)
+                and item.get("type") == "text"
+                and item.get("text")
+            ]
+        return []
+
+    @classmethod
+    def _image_tokens(cls, content: Any) -> int:
+        """Fixed token charge for the image parts of multimodal content."""
+        if not isinstance(content, list):
+            return 0
+        images = sum(
+            1
+            for item in content
+            if isinstance(item, dict) and item.get("type") == "image_url"
+        )
+        return images * cls.IMAGE_PART_TOKENS
+
+    def count_message_tokens(self, msg: dict) -> int:
+        """Count tokens in a message (cached per message object within inlet)."""
+        cache = _MSG_TOKENS.get()
+        content, parts, total = self._cache_lookup(msg, cache)
+        if total is None:
+            total = self._image_tokens(content) + sum(
+                self.count_tokens(t) for t in self._text_segments(content)
+            )
+            if cache is not None:
+                cache[id(msg)] = (content, parts, total)
+        return total
 
     def count_all_tokens(self, messages: list) -> int:
-        """Count total tokens across all messages."""
-        return sum(self.count_message_tokens(msg) for msg in messages)
+        """
+        Count total tokens across all messages with one batched encode.
+
+        Uncached message text (including multimodal text parts) is tokenized
+        in a single encode_ordinary_batch call, amortizing the per-call
+        overhead of dropping into tiktoken's Rust core.
+        """
+        return sum(self.count_all_tokens_batched_multimodal(messages))
+
+    def count_all_tokens_batched_multimodal(self, messages: list) -> list:
+        """
+        Per-message token counts, tokenizing all uncached text in one batch.
+
+        Text parts from every uncached message (string content or multimodal
+        text items) are flattened into text -> msg_idx owners, each distinct
+        uncounted text is encoded in a single encode_ordinary_batch call, and
+        the lengths scattered back onto their messages.
+        """
+        counts = [0] * len(messages)
+        # Outside inlet, still share counts between messages of this call
+        text_counts = _TEXT_TOKENS.get()
+        if text_counts is None:
+            text_counts = {}
+        owners: dict[str, list] = {}  # text -> msg_idx of each message using it
+        pending = {}  # msg_idx -> (msg, content, parts)
+        cache = _MSG_TOKENS.get()
+        cache_lookup = self._cache_lookup
+        image_tokens = self._image_tokens
+        text_segments = self._text_segments
+        for i, msg in enumerate(messages):
+            content, parts, cached = cache_lookup(msg, cache)
+            if cached is not None:
+                counts[i] = cached
+                continue
+            pending[i] = (msg, content, parts)
+            counts[i] = image_tokens(content)
+            for text in text_segments(content):
+                count = text_counts.get(text)
+                if count is not None:
+                    counts[i] += count
+                else:
+                    owners.setdefault(text, []).append(i)
+
+        if owners:
+            # Each distinct text is encoded once, however many messages share it
+            texts = list(owners)
+            if len(texts) == 1:
+                # A single text gains nothing from a thread pool
+                encoded = [self.encoding.encode_ordinary(texts[0])]
+            else:
+                encoded = self.encoding.encode_ordinary_batch(
+                    texts, num_threads=min(_ENCODE_THREADS, len(texts))
+                )
+            for text, tokens in zip(texts, encoded):
+                count = text_counts[text] = len(tokens)
+                for i in owners[text]:
+                    counts[i] += count
+        if cache is not None:
+            for i, (msg, content, parts) in pending.items():
+                cache[id(msg)] = (content, parts, counts[i])
+        return counts
+
+    def estimate_tokens_fast(self, messages: list) -> int:
+        """Upper bound on total tokens from the UTF-8 byte length, without tokenizing."""
+        size = 0
+        image_tokens = 0
+        text_segments = self._text_segments
+        count_images = self._image_tokens
+        for msg in messages:
+            content = msg.get("content", "")
+            if isinstance(content, str):
+                size += _utf8_len(content)
+            else:
+                for text in text_segments(content):
+                    size += _utf8_len(text)
+                image_tokens += count_images(content)
+        return size + image_tokens
 
     def extract_base_system_prompt(self, messages: list) -> Tuple[list, list]:
         """
@@ -132,14 +642,14 @@ class Filter:
 
         Returns: (base_system_messages, remaining_messages)
         """
-        if not messages:
-            return [], []
-
         # Only preserve the FIRST system message (the base model prompt)
-        if messages[0].get("role") == "system":
-            return [messages[0]], messages[1:]
+        end = self._system_prompt_end(messages)
+        return messages[:end], messages[end:]
 
-        return [], messages
+    @staticmethod
+    def _system_prompt_end(messages: list) -> int:
+        """Index where the conversation starts, after any base system prompt."""
+        return 1 if messages and messages[0].get("role") == "system" else 0
 
     def has_embedded_tool_result(self, content: str) -> bool:
         """
@@ -151,25 +661,34 @@ class Filter:
         if not content:
             return False
 
-        # Look for patterns indicating embedded tool results:
-        # 1. HTML-escaped JSON: &quot;results&quot; or &quot;error&quot;
-        # 2. Double-escaped JSON: \"results\" or \\&quot;
-        # 3. Raw JSON patterns at start: {"results" or [{"
-        patterns = [
-            r"&quot;results&quot;",
-            r"&quot;error&quot;",
-            r"\\&quot;results\\&quot;",
-            r'\\"results\\"',
-            r'^[\s\n]*\{["\']results',
-            r"^[\s\n]*\[\{",
-            r'^[\s\n]*"&quot;',  # Starts with escaped quote (common pattern)
-        ]
+        # Only the first 1000 chars are checked
+        head = content[:1000]
+
+        # Every pattern contains one of these substrings (a quote always
+        # precedes "results"); prose has none, even when it mentions results,
+        # so skip the regex entirely for the common case
+        if (
+            "&quot;" not in head
+            and "[{" not in head
+            and '"results' not in head
+            and "'results" not in head
+        ):
+            return False
 
-        for pattern in patterns:
-            if re.search(pattern, content[:1000]):  # Check first 1000 chars
-                return True
+        return _TOOL_RESULT_RE.search(head) is not None
 
-        return False
+    def _decode_content(self, content: str) -> str:
+        """Decode HTML entities and JSON backslash escapes in message content."""
+        try:
+            # HTML entities (e.g., &quot; -> ", &#x27; -> '), then escaped
+            # quotes and newlines from JSON serialization; each pass is
+            # skipped when its marker character is absent
+            decoded = _unescape_entities(content) if "&" in content else content
+            if "\\" in decoded:
+                decoded = _unescape_backslashes(decoded)
+        except Exception:
+            decoded = content
+        return decoded
 
     def extract_tool_result_info(self, content: str) -> dict:
         """
@@ -182,6 +701,10 @@ class Filter:
         - has_error: bool
         - error_count: int (number of failed tool calls)
         """
+        return self._extract_tool_result_info(content)[0]
+
+    def _extract_tool_result_info(self, content: str) -> Tuple[dict, str]:
+        """Extract tool result info, also returning the decoded content."""
         info = {
             "has_results": False,
             "result_count": None,
@@ -191,78 +714,47 @@ class Filter:
         }
 
         if not content:
-            return info
+            return info, content
 
-        # Decode HTML entities (e.g., &quot; -> ", &#x27; -> ')
-        try:
-            decoded = html.unescape(content)
-            # Also handle escaped quotes and newlines from JSON serialization
-            decoded = decoded.replace('\\"', '"').replace("\\n", "\n")
-        except Exception:
-            decoded = content
+        decoded = self._decode_content(content)
 
         # Count error messages (query execution failed patterns)
-        error_matches = re.findall(r"query execution failed", decoded, re.IGNORECASE)
+        error_matches = _count_errors(decoded)
         if error_matches:
             info["has_error"] = True
-            info["error_count"] = (
-                len(error_matches) // 2
-            )  # Usually duplicated in message
-
-        # Try to find and parse the successful result JSON
-        # Look for {"results": [...]} pattern
-        results_match = re.search(r'\{\s*"results"\s*:\s*\[([\s\S]*?)\]\s*\}', decoded)
-        if results_match:
-            try:
-                json_str = '{"results": [' + results_match.group(1) + "]}"
-                json_str = json_str.replace('\\"', '"').replace("\\n", "\n")
-                data = json.loads(json_str)
-
-                if "results" in data and isinstance(data["results"], list):
-                    results = data["results"]
-                    info["has_results"] = True
-                    info["result_count"] = len(results)
-
-                    # Get sample row (first row with truncated string values)
-                    if results and isinstance(results[0], dict):
-                        sample = {}
-                        for k, v in results[0].items():
-                            if isinstance(v, str) and len(v) > 40:
-                                sample[k] = v[:40] + "..."
-                            else:
-                                sample[k] = v
-                        info["sample_row"] = sample
-            except json.JSONDecodeError:
-                pass
-
-        # Fallback: try to find raw JSON array
-        if not info["has_results"]:
-            array_match = re.search(r"\[\s*\{[\s\S]*?\}\s*\]", decoded)
-            if array_match:
-                try:
-                    json_str = (
-                        array_match.group(0).replace('\\"', '"').replace("\\n", "\n")
-                    )
-                    data = json.loads(json_str)
-                    if isinstance(data, list) and data:
-                        info["has_results"] = True
-                        info["result_count"] = len(data)
-                        if isinstance(data[0], dict):
-                            sample = {}
-                            for k, v in data[0].items():
-                                if isinstance(v, str) and len(v) > 40:
-                                    sample[k] = v[:40] + "..."
-                                else:
-                                    sample[k] = v
-                            info["sample_row"] = sample
-                except json.JSONDecodeError:
-                    pass
+            info["error_count"] = error_matches // 2  # Usually duplicated in message
+
+        # Try to find and parse the successful result JSON: a {"results": [...]}
+        # object first, then any raw array of objects. Both are located by
+        # bracket matching, which stays linear on large tool output; the
+        # regexes are only a fallback for content the scan can't parse.
+        results = _find_results_array(decoded)
+        if results is None:
+            results = _match_results_array(decoded)
+        if results is None:
+            results = _find_object_array(decoded)
+        if results is None:
+            results = _match_object_array(decoded)
+
+        if results is not None:
+            info["has_results"] = True
+            info["result_count"] = len(results)
+
+            # Get sample row (first row with truncated string values)
+            if results and isinstance(results[0], dict):
+                sample = {}
+                for k, v in results[0].items():
+                    if isinstance(v, str) and len(v) > 40:
+                        sample[k] = v[:40] + "..."
+                    else:
+                        sample[k] = v
+                info["sample_row"] = sample
 
         # Final fallback: pattern-based detection
         if not info["has_results"] and self.has_embedded_tool_result(content):
             info["has_results"] = True
 
-        return info
+        return info, decoded
 
     def compact_assistant_with_tool_result(self, msg: dict) -> dict:
         """
@@ -275,7 +767,7 @@ class Filter:
         if not content:
             return msg
 
-        info = self.extract_tool_result_info(content)
+        info, decoded = self._extract_tool_result_info(content)
 
         # Build description of the tool result
         parts = []
@@ -289,10 +781,7 @@ class Filter:
             parts.append(f"{info['result_count']} rows")
             if info["sample_row"]:
                 # Format sample row compactly
-                sample_str = json.dumps(info["sample_row"], ensure_ascii=False)
-                if len(sample_str) > 120:
-                    sample_str = sample_str[:120] + "...}"
-                parts.append(sample_str)
+                parts.append(_format_sample_row(info["sample_row"]))
         elif info["has_results"]:
             parts.append("results returned")
 
@@ -302,42 +791,43 @@ class Filter:
             char_count = len(content)
             result_desc = f"[Tool: {char_count:,} chars]"
 
-        # Try to extract any conversational text after the tool results
-        # Often the assistant adds commentary/analysis after showing results
+        # Keep any conversational text after the tool results
+        commentary = self._extract_commentary(decoded)
+        if commentary:
+            return {
+                "role": "assistant",
+                "content": f"{result_desc}\n\n{commentary}",
+            }
+        return {"role": "assistant", "content": result_desc}
+
+    def _extract_commentary(self, decoded: str) -> Optional[str]:
+        """
+        Return assistant commentary following the last JSON block, if any.
+
+        Often the assistant adds commentary/analysis after showing results.
+        """
         try:
-            decoded = html.unescape(content)
             # Look for markdown or plain text after the last JSON block
             # Pattern: find content after the last }" that looks like prose
-            last_json_end = max(
-                decoded.rfind('}"'),
-                decoded.rfind("}'"),
-                decoded.rfind('}]"'),
-            )
+            last_json_end = _rfind_json_block_end(decoded)
             if last_json_end > 0:
                 after_json = decoded[last_json_end + 2 :].strip()
                 # Check if there's meaningful commentary (not just whitespace or quotes)
-                cleaned = re.sub(r'^[\s"\'\n]+', "", after_json)
+                cleaned = _LEADING_QUOTES_RE.sub("", after_json)
                 if len(cleaned) > 30:
                     # Truncate if too long
                     if len(cleaned) > 500:
                         cleaned = cleaned[:500] + "..."
-                    return {
-                        "role": "assistant",
-                        "content": f"{result_desc}\n\n{cleaned}",
-                    }
+                    return cleaned
         except Exception:
             pass
-
-        return {"role": "assistant", "content": result_desc}
+        return None
 
     def split_conversation(self, messages: list, keep_count: int) -> Tuple[list, list]:
         """
         Split conversation messages into old (to summarize) and recent (to keep intact).
         """
-        if len(messages) <= keep_count:
-            return [], messages
-
-        split_idx = len(messages) - keep_count
+        split_idx = max(len(messages) - keep_count, 0)
         return messages[:split_idx], messages[split_idx:]
 
     def find_dynamic_split(
@@ -354,21 +844,27 @@ class Filter:
 
         Returns: (old_messages, recent_messages)
         """
-        keep_count = initial_keep
+        split_idx = self._dynamic_split_index(len(messages), initial_keep, min_keep)
+        return messages[:split_idx], messages[split_idx:]
 
-        while keep_count >= min_keep:
-            old_messages, recent_messages = self.split_conversation(
-                messages, keep_count
-            )
-            if old_messages:
-                return old_messages, recent_messages
+    @staticmethod
+    def _dynamic_split_index(count: int, initial_keep: int, min_keep: int) -> int:
+        """
+        Index splitting count messages into old [:idx] and recent [idx:].
+
+        Halves the keep count until something is left to summarize; 0 means
+        nothing can be summarized.
+        """
+        keep_count = initial_keep
+        while keep_count >= max(min_keep, 1):
+            if count > keep_count:
+                return count - keep_count
             keep_count = keep_count // 2
 
         # Last resort: keep minimum and summarize rest
-        if len(messages) > min_keep:
-            return messages[:-min_keep], messages[-min_keep:]
-
-        return [], messages
+        if count > min_keep:
+            return count - min_keep
+        return 0
 
     def prepare_for_summarization(self, messages: list) -> Tuple[list, list]:
         """
@@ -385,35 +881,42 @@ class Filter:
         """
         prepared = []
         tool_summaries = []
+        threshold = self.valves.tool_result_token_threshold
+        # Bound methods hoisted out of the per-message loop
+        keep = prepared.append
+        has_tool_result = self.has_embedded_tool_result
+        count_message_tokens = self.count_message_tokens
+        compact = self.compact_assistant_with_tool_result
 
         for msg in messages:
-            role = msg.get("role", "")
-            content = msg.get("content", "")
+            get = msg.get
+            role = get("role", "")
+            content = get("content", "")
 
             if role == "system":
                 # Skip system messages - RAG will re-retrieve
                 continue
             elif role == "assistant":
                 # Check if this has embedded tool results
-                if self.has_embedded_tool_result(content):
-                    token_count = self.count_tokens(content)
-                    if token_count > self.valves.tool_result_token_threshold:
+                if has_tool_result(content):
+                    token_count = count_message_tokens(msg)
+                    if token_count > threshold:
                         # Compact the tool result
-                        compacted = self.compact_assistant_with_tool_result(msg)
-                        prepared.append(compacted)
+                        compacted = compact(msg)
+                        keep(compacted)
                         # Extract just the tool summary line for separate inclusion
                         compacted_content = compacted.get("content", "")
-                        tool_match = re.match(r"(\[Tool:[^\]]+\])", compacted_content)
+                        tool_match = _TOOL_SUMMARY_RE.match(compacted_content)
                         if tool_match:
                             tool_summaries.append(tool_match.group(1))
                     else:
                         # Small enough to keep as-is
-                        prepared.append(msg)
+                        keep(msg)
                 else:
                     # Regular assistant message
-                    prepared.append(msg)
+                    keep(msg)
             elif role == "user":
-                prepared.append(msg)
+                keep(msg)
 
         return prepared, tool_summaries
 
@@ -421,113 +924,203 @@ class Filter:
         """Build the prompt for summarizing messages."""
         conversation_parts = []
         for msg in messages:
-            role = msg.get("role", "unknown").upper()
-            content = msg.get("content", "")
+            get = msg.get
+            content = get("content", "")
             if isinstance(content, str) and content.strip():
+                role = get("role", "unknown")
+                role = _ROLE_UPPER.get(role) or role.upper()
                 conversation_parts.append(f"{role}: {content}")
 
         if not conversation_parts:
             return ""
 
-        conversation = "\n\n".join(conversation_parts)
-
-        return f"""Summarize the following conversation concisely, preserving key facts, decisions, queries made, and context needed to continue the conversation:
-
-{conversation}
+        return (
+            _SUMMARY_PROMPT_HEADER
+            + "\n\n".join(conversation_parts)
+            + _SUMMARY_PROMPT_FOOTER
+        )
 
-Provide a clear, factual summary in 2-3 paragraphs."""
+    def _chunk_messages(self, messages: list, max_tokens: int) -> list:
+        """
+        Split messages into consecutive chunks of roughly equal token count,
+        each at most about max_tokens (max_tokens <= 0 means a single chunk).
+        """
+        if not messages:
+            return []
+        counts = [self.count_message_tokens(msg) for msg in messages]
+        total = sum(counts)
+        if max_tokens <= 0 or total <= max_tokens:
+            return [messages]
+
+        target = total / -(-total // max_tokens)  # ceil division
+        chunks = []
+        current = []
+        current_tokens = 0
+        for msg, tokens in zip(messages, counts):
+            if current and current_tokens + tokens > target:
+                chunks.append(current)
+                current = []
+                current_tokens = 0
+            current.append(msg)
+            current_tokens += tokens
+        if current:
+            chunks.append(current)
+        return chunks
+
+    async def _summarize_prompt(self, prompt: str, model: str) -> str:
+        """Send one summarization prompt to Ollama."""
+        response = await _get_client().post(
+            f"{self.valves.ollama_url}/api/generate",
+            content=_json_dumps_bytes(
+                {"model": model, "prompt": prompt, "stream": False}
+            ),
+            headers=_JSON_HEADERS,
+        )
+        result = response.json()
+        return result.get("response", "")
 
     async def summarize_messages(self, messages: list, model: str) -> str:
-        """Call Ollama to summarize user/assistant conversation."""
-        prompt = self._build_summarization_prompt(messages)
-        if not prompt:
+        """
+        Call Ollama to summarize user/assistant conversation.
+
+        Histories larger than summary_chunk_tokens are split into chunks that
+        are summarized concurrently and joined. Ollama only serves them in
+        parallel when OLLAMA_NUM_PARALLEL allows several requests per model.
+        If any chunk comes back empty the whole summary is treated as failed,
+        so part of the history is never silently dropped; if one raises, the
+        remaining requests are cancelled.
+        """
+        chunks = self._chunk_messages(messages, self.valves.summary_chunk_tokens)
+        prompts = [self._build_summarization_prompt(chunk) for chunk in chunks]
+        prompts = [prompt for prompt in prompts if prompt]
+        if not prompts:
             return ""
 
-        async with httpx.AsyncClient(timeout=120.0) as client:
-            response = await client.post(
-                f"{self.valves.ollama_url}/api/generate",
-                json={"model": model, "prompt": prompt, "stream": False},
-            )
-            result = response.json()
-            return result.get("response", "")
+        if len(prompts) == 1:
+            summaries = [await self._summarize_prompt(prompts[0], model)]
+        else:
+            tasks = [
+                asyncio.create_task(self._summarize_prompt(prompt, model))
+                for prompt in prompts
+            ]
+            try:
+                summaries = await asyncio.gather(*tasks)
+            except BaseException:
+                # The summary is lost once any chunk fails; stop the others
+                # instead of leaving them running against Ollama
+                for task in tasks:
+                    task.cancel()
+                raise
+        if not all(summaries):
+            return ""
+        return "\n\n".join(summaries)
 
     async def inlet(
         self,
         body: dict,
         __user__: Optional[dict] = None,
         __event_emitter__: Callable[[Any], Awaitable[None]] = None,
+    ) -> dict:
+        with _call_caches():
+            return await self._inlet(body, __event_emitter__)
+
+    async def _inlet(
+        self,
+        body: dict,
+        __event_emitter__: Optional[Callable[[Any], Awaitable[None]]],
     ) -> dict:
         messages = body.get("messages", [])
         if not messages:
             self._debug("No messages in body, passing through")
             return body
 
-        token_count = self.count_all_tokens(messages)
+        # Cheap upper bound first; exact counting only when it's needed
+        token_count = self.estimate_tokens_fast(messages)
+        # Debug-only work (message summaries, prompt previews, extra token
+        # counts) is skipped entirely unless debug logging is on
+        valves = self.valves
+        debug = valves.debug_logging
+        threshold = valves.token_threshold
+
+        # The estimate is an upper bound, so a conversation under the
+        # threshold by that measure is under it exactly; only tokenize when
+        # the bound reaches it
+        exact = not valves.enable_fast_token_estimate or token_count >= threshold
+        if exact:
+            # Tokenize off the event loop; tiktoken releases the GIL, so other
+            # requests keep running (and counting) meanwhile
+            token_counts = await asyncio.to_thread(
+                self.count_all_tokens_batched_multimodal, messages
+            )
+            token_count = sum(token_counts)
+        approx = "" if exact else "<="
         self._debug(
-            f"=== INLET START === Total tokens: {token_count:,}, Threshold: {self.valves.token_threshold:,}"
+            f"=== INLET START === Total tokens: {approx}{token_count:,}, Threshold: {threshold:,}"
         )
-        self._debug(self._format_messages_summary(messages, "INPUT"))
+        self._debug_messages(messages, "INPUT")
 
         # Dump full message content if enabled (for debugging message format)
-        if self.valves.dump_full_messages:
-            print(
-                f"[ContextSummarization] === FULL MESSAGE DUMP ({len(messages)} messages) ==="
+        if valves.dump_full_messages:
+            info = _logger.info
+            info(
+                "[ContextSummarization] === FULL MESSAGE DUMP (%d messages) ===",
+                len(messages),
             )
             for i, msg in enumerate(messages):
-                role = msg.get("role", "unknown")
-                content = msg.get("content", "")
-                print(f"[ContextSummarization] --- MESSAGE {i} ({role}) ---")
-                print(f"[ContextSummarization] {content}")
-                print(f"[ContextSummarization] --- END MESSAGE {i} ---")
-            print(f"[ContextSummarization] === END FULL MESSAGE DUMP ===")
-
-        if token_count < self.valves.token_threshold:
+                info(
+                    "[ContextSummarization] --- MESSAGE %d (%s) ---\n"
+                    "[ContextSummarization] %s\n"
+                    "[ContextSummarization] --- END MESSAGE %d ---",
+                    i,
+                    msg.get("role", "unknown"),
+                    msg.get("content", ""),
+                    i,
+                )
+            info("[ContextSummarization] === END FULL MESSAGE DUMP ===")
+
+        if token_count < threshold:
             self._debug(
-                f"Under threshold ({token_count:,} < {self.valves.token_threshold:,}), passing through"
+                f"Under threshold ({approx}{token_count:,} < {threshold:,}), passing through"
             )
             return body  # No summarization needed
 
-        self._debug(
-            f"TRIGGERED: {token_count:,} tokens >= {self.valves.token_threshold:,} threshold"
-        )
+        self._debug(f"TRIGGERED: {token_count:,} tokens >= {threshold:,} threshold")
 
-        # Show status to user
-        if __event_emitter__:
-            await __event_emitter__(
-                {
-                    "type": "status",
-                    "data": {
-                        "description": f"Summarizing conversation ({token_count:,} tokens)...",
-                        "done": False,
-                    },
-                }
-            )
+        # Status shown to the user; sent alongside step 3 below
+        summarizing_status = {
+            "type": "status",
+            "data": {
+                "description": f"Summarizing conversation ({token_count:,} tokens)...",
+                "done": False,
+            },
+        }
 
         # Step 1: Extract base system prompt only (let RAG re-retrieve knowledge)
-        system_messages, conversation = self.extract_base_system_prompt(messages)
+        conversation_start = self._system_prompt_end(messages)
         self._debug(
-            f"Extracted {len(system_messages)} system message(s), {len(conversation)} conversation messages"
+            f"Extracted {conversation_start} system message(s), {len(messages) - conversation_start} conversation messages"
         )
-        if system_messages:
-            system_tokens = self.count_all_tokens(system_messages)
+        if conversation_start:
+            system_tokens = sum(token_counts[:conversation_start])
             self._debug(f"System prompt tokens: {system_tokens:,}")
 
         # Step 2: Split conversation into old and recent (with dynamic adjustment)
-        old_messages, recent_messages = self.find_dynamic_split(
-            conversation,
-            self.valves.messages_to_keep,
-            self.valves.min_messages_to_keep,
+        split_idx = conversation_start + self._dynamic_split_index(
+            len(messages) - conversation_start,
+            valves.messages_to_keep,
+            valves.min_messages_to_keep,
         )
         self._debug(
-            f"Split: {len(old_messages)} old messages, {len(recent_messages)} recent messages"
+            f"Split: {split_idx - conversation_start} old messages, {len(messages) - split_idx} recent messages"
         )
 
-        if not old_messages:
+        if split_idx == conversation_start:
             # Can't summarize - warn user and pass through
             self._debug(
                 "WARNING: No old messages to summarize, passing through unchanged"
             )
             if __event_emitter__:
+                await __event_emitter__(summarizing_status)
                 await __event_emitter__(
                     {
                         "type": "status",
@@ -539,20 +1132,34 @@ Provide a clear, factual summary in 2-3 paragraphs."""
                 )
             return body
 
-        self._debug(self._format_messages_summary(old_messages, "OLD (to summarize)"))
-        self._debug(self._format_messages_summary(recent_messages, "RECENT (to keep)"))
+        # Only the old messages are materialized; the system prompt and recent
+        # messages are copied straight from the input when reconstructing
+        old_messages = messages[conversation_start:split_idx]
 
-        # Step 3: Prepare old messages for summarization (compacts tool results)
-        prepared_messages, tool_summaries = self.prepare_for_summarization(old_messages)
-        prepared_tokens = self.count_all_tokens(prepared_messages)
-        self._debug(
-            f"Prepared {len(prepared_messages)} messages for summarization ({prepared_tokens:,} tokens)"
-        )
-        self._debug(f"Extracted {len(tool_summaries)} tool summaries to append")
-        self._debug(self._format_messages_summary(prepared_messages, "PREPARED"))
+        if debug:
+            self._debug_messages(old_messages, "OLD (to summarize)")
+            self._debug_messages(messages[split_idx:], "RECENT (to keep)")
+
+        # Step 3: Prepare old messages for summarization (compacts tool results).
+        # Compaction runs in a worker thread so the status event goes out to
+        # the user while it works.
+        prepare = asyncio.to_thread(self.prepare_for_summarization, old_messages)
+        if __event_emitter__:
+            _, (prepared_messages, tool_summaries) = await asyncio.gather(
+                __event_emitter__(summarizing_status), prepare
+            )
+        else:
+            prepared_messages, tool_summaries = await prepare
+        if debug:
+            prepared_tokens = self.count_all_tokens(prepared_messages)
+            self._debug(
+                f"Prepared {len(prepared_messages)} messages for summarization ({prepared_tokens:,} tokens)"
+            )
+            self._debug(f"Extracted {len(tool_summaries)} tool summaries to append")
+            self._debug_messages(prepared_messages, "PREPARED")
 
         # Step 4: Get model for summarization
-        model = self.valves.summarizer_model or body.get("model", "")
+        model = valves.summarizer_model or body.get("model", "")
         self._debug(f"Using model for summarization: {model}")
 
         # Step 5: Generate summary of conversation (with graceful degradation)
@@ -560,21 +1167,29 @@ Provide a clear, factual summary in 2-3 paragraphs."""
         summarization_failed = False
         try:
             self._debug("Calling Ollama for summarization...")
-            prompt = self._build_summarization_prompt(prepared_messages)
-            # Show the prompt being sent to the summarization model
-            self._debug(f"Summarization prompt ({len(prompt)} chars):\n{prompt}")
-            if not prompt:
-                self._debug("WARNING: Summarization prompt is empty!")
+            if debug:
+                # Show what's being sent to the summarization model; the full
+                # prompt is only rebuilt here when full dumps are requested
+                if valves.dump_full_messages:
+                    prompt = self._build_summarization_prompt(prepared_messages)
+                    self._debug(
+                        f"Summarization prompt ({len(prompt)} chars):\n{prompt}"
+                    )
+                else:
+                    prompt = _preview(prepared_messages)
+                    self._debug(f"Summarization prompt preview:\n{prompt}")
+                if not prompt:
+                    self._debug("WARNING: Summarization prompt is empty!")
             summary = await self.summarize_messages(prepared_messages, model)
-            if summary:
+            if summary and debug:
                 self._debug(
                     f"Summarization complete: {len(summary)} chars, {self.count_tokens(summary):,} tokens"
                 )
-                if not self.valves.dump_full_messages:
+                if not valves.dump_full_messages:
                     self._debug(f"Summary:\n{summary}")
-            else:
+            elif not summary:
                 self._debug(
-                    f"WARNING: Summarization returned empty (prompt was {len(prompt)} chars)"
+                    f"WARNING: Summarization returned empty ({len(prepared_messages)} messages sent)"
                 )
         except Exception as e:
             summarization_failed = True
@@ -592,27 +1207,29 @@ Provide a clear, factual summary in 2-3 paragraphs."""
                     }
                 )
 
-        # Step 6: Reconstruct messages
-        if summarization_failed or not summary:
+        # Step 6: Reconstruct messages. The inserted system message is built
+        # from parts and joined once.
+        summarized = bool(summary) and not summarization_failed
+        if summarized:
+            # Normal case: include summary + tool summaries
+            parts = ["[Previous conversation summary]\n", summary]
+        else:
             # Fallback: just use system + recent messages (truncation without summary)
             self._debug("FALLBACK: Using truncation without summary")
-            fallback_content = "[Note: Earlier conversation was truncated due to context limits. Some context may be missing.]"
-            # Still include tool summaries if we have them
-            if tool_summaries:
-                fallback_content += "\n\n[Tool calls from earlier in conversation]\n"
-                fallback_content += "\n".join(f"- {ts}" for ts in tool_summaries)
-            fallback_note = {"role": "system", "content": fallback_content}
-            new_messages = system_messages + [fallback_note] + recent_messages
-        else:
-            # Normal case: include summary + tool summaries
-            summary_content = f"[Previous conversation summary]\n{summary}"
-            if tool_summaries:
-                summary_content += "\n\n[Tool calls from earlier in conversation]\n"
-                summary_content += "\n".join(f"- {ts}" for ts in tool_summaries)
-            summary_content += "\n[End of summary - recent messages follow]"
-            summary_message = {"role": "system", "content": summary_content}
-            new_messages = system_messages + [summary_message] + recent_messages
-
+            parts = [
+                "[Note: Earlier conversation was truncated due to context limits. Some context may be missing.]"
+            ]
+        # Include tool summaries if we have them (even without a summary)
+        if tool_summaries:
+            parts.append("\n\n[Tool calls from earlier in conversation]\n")
+            parts.append("\n".join(f"- {ts}" for ts in tool_summaries))
+        if summarized:
+            parts.append("\n[End of summary - recent messages follow]")
+        inserted = {"role": "system", "content": "".join(parts)}
+
+        new_messages = messages[:conversation_start]
+        new_messages.append(inserted)
+        new_messages.extend(messages[split_idx:])
         body["messages"] = new_messages
 
         # Log final state
@@ -622,12 +1239,12 @@ Provide a clear, factual summary in 2-3 paragraphs."""
             f"Token reduction: {token_count:,} → {new_token_count:,} ({token_count - new_token_count:,} tokens saved)"
         )
         self._debug(f"Message reduction: {len(messages)} → {len(new_messages)}")
-        self._debug(self._format_messages_summary(new_messages, "OUTPUT"))
+        self._debug_messages(new_messages, "OUTPUT")
 
         # Update status
         if __event_emitter__:
             status_msg = f"Summarized: {token_count:,} → {new_token_count:,} tokens"
-            if summarization_failed:
+            if not summarized:
                 status_msg = f"Truncated: {token_count:,} → {new_token_count:,} tokens (summarization failed)"
             await __event_emitter__(
                 {
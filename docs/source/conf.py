@@ -1,7 +1,7 @@
-import pathlib
+import os
 import sys
 
-sys.path.insert(0, pathlib.Path(__file__).parents[2].resolve().as_posix())
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
 
 project = "Scout"
 copyright = "2026, Washington University in St. Louis"
@@ -20,11 +20,15 @@ extensions = [
     "myst_parser",
 ]
 
+# No page uses autosummary directives, so skip stub generation on every build
+autosummary_generate = False
+
 intersphinx_mapping = {
     "python": ("https://docs.python.org/3/", None),
     "sphinx": ("https://www.sphinx-doc.org/en/master/", None),
 }
 intersphinx_disabled_domains = ["std"]
+intersphinx_cache_limit = 90  # days to reuse fetched inventories
 
 templates_path = ["_templates"]
 